@@ -85,35 +85,33 @@ def remote_check(s3, verify, tarstorageclass):
     else:
         files = s3.list_files()
         outdated = {}
-    # Sanity check of the files
-    jsonfiles = [file for file in files if file.startswith("db/") and file.endswith(".json")]
-    tarfiles = [file for file in files if file.startswith("data/") and file.endswith(".tar")]
+    # Sanity check of the files, in a single pass: collect sets of json and
+    # tar base names, they are cross-checked afterwards.
+    jsonbases = set()
+    tarbases = set()
+    for file, s3file in files.items():
+        if file.startswith("db/") and file.endswith(".json"):
+            jsonbases.add(file.removeprefix("db/").removesuffix(".json"))
+        elif file.startswith("data/") and file.endswith(".tar"):
+            tarbases.add(file.removeprefix("data/").removesuffix(".tar"))
+            if s3file.storageclass != tarstorageclass:
+                print(f"WARNING: Remote {file} in incorrect storage class {s3file.storageclass} is not expected {tarstorageclass}.")
+                warnings += 1
+        elif not (file.startswith("report/") and file.endswith(".csv")):
+            print(f"WARNING: Remote {file} not supposed to be in bucket.")
+            warnings += 1
 
-    for jsonfile in jsonfiles:
-        base = jsonfile.removeprefix("db/").removesuffix(".json")
-        if "data/" + base + ".tar" not in tarfiles:
+    # Only bases that are in one set but not the other
+    for base in sorted(jsonbases ^ tarbases):
+        if base in jsonbases:
             print(f"ERROR on remote: {base}.json without the corresponding tar.")
             errors += 1
-
-    for tar in tarfiles:
-        base = tar.removeprefix("data/").removesuffix(".tar")
-        if "db/" + base + ".json" not in jsonfiles:
+        else:
             print(f"WARNING: Remote {base}.tar without the corresponding json.")
             warnings += 1
-        if files[tar].storageclass != tarstorageclass:
-            print(f"WARNING: Remote {tar} in incorrect storage class {files[tar].storageclass} is not expected {tarstorageclass}.")
-            warnings += 1
-
-    for file in files:
-        if file.startswith("report/") and file.endswith(".csv"):
-            continue
-        if file in jsonfiles or file in tarfiles:
-            continue
-        print(f"WARNING: Remote {file} not supposed to be in bucket.")
-        warnings += 1
 
+    # outdated can also list files that were deleted, that are not in files
     for file in outdated:
-        prefix = ""
         print(f"WARNING: Remote {file} has one of more outdated copies (noncurrent), that probably should be expired.")
         warnings += 1
 
@@ -124,9 +122,18 @@ def remote_check(s3, verify, tarstorageclass):
 
     return (warnings, errors)
 
+class SaneTable(dict):
+    # str.translate table replacing non-alphanumeric characters with "_",
+    # filled on demand so that it covers all of unicode.
+    def __missing__(self, c):
+        self[c] = c if chr(c).isalnum() else ord("_")
+        return self[c]
+
+SANE_TABLE = SaneTable()
+
 def gen_cache_directory(outurl):
     # TODO: Not sure if this is cross-platform
-    saneurl = "".join([ c if c.isalnum() else "_" for c in outurl ])
+    saneurl = outurl.translate(SANE_TABLE)
     return pathlib.Path.home() / ".cache" / "simple-uploader" / saneurl
 
 ### Main
@@ -141,6 +148,10 @@ def main():
     parser.add_argument('s3url', help="S3 URL, i.e. s3://bucket/directory")
     parser.add_argument('-v', '--verify', action='store_true', help="Verify remote bucket configuration and state.")
     parser.add_argument('-i', '--input', action='store', dest='indir', type=str, help="Input directory")
+    parser.add_argument('-C', '--checksum', action='store_true', help="Always compute SHA-256 of local files, even if size and modification time match the database.")
+    parser.add_argument('-j', '--jobs', action='store', type=int, default=BackupDatabase.DEFAULT_HASHWORKERS, help="Number of files hashed in parallel.")
+    parser.add_argument('-p', '--pending-tars', action='store', type=int, default=BackupDatabase.DEFAULT_PENDINGTARS, help="Number of tars that can wait for their upload to complete, while the next one is being created.")
+    parser.add_argument('--list-cache', action='store', type=int, default=0, metavar="SECONDS", help="Reuse the listing of the bucket for that many seconds (0 to disable). Only use this if nothing else writes to the bucket.")
     parser.add_argument('-c', '--class', action='store', dest='storageclass', type=str, default="DEEP_ARCHIVE", help="upload class (e.g. STANDARD or DEEP_ARCHIVE)")
     args = parser.parse_args()
 
@@ -162,7 +173,8 @@ def main():
 
     # Sync and load database
     print("Syncing database...")
-    s3 = SimpleS3(outurl, dry_run=args.dry_run)
+    listcache = dbcachedir.parent / (dbcachedir.name + ".list.json")
+    s3 = SimpleS3(outurl, dry_run=args.dry_run, listcache=listcache, listcachettl=args.list_cache)
     (warnings, errors) = remote_check(s3, args.verify, storageclass)
     print(f"{errors} errors and {warnings} warnings while checking remote.")
     if errors > 0:
@@ -170,7 +182,10 @@ def main():
 
     s3.download_dir(dbcachedir, "db")
 
-    backupdb = BackupDatabase(dbcachedir, s3)
+    # Index next to the cache directory: download_dir moves unknown files away
+    dbindex = dbcachedir.parent / (dbcachedir.name + ".sqlite")
+    backupdb = BackupDatabase(dbcachedir, s3, hashworkers=args.jobs,
+            pendingtars=args.pending_tars, indexfile=dbindex)
     backupdb.read_database()
 
     if indir is None:
@@ -179,7 +194,7 @@ def main():
 
     # List local files and back them up
     inlist = list_files(indir)
-    (totalwritten, totalskip) = backupdb.create_tars(indir, inlist, storageclass)
+    (totalwritten, totalskip) = backupdb.create_tars(indir, inlist, storageclass, checksum=args.checksum)
 
     if totalwritten > 0:
         print("Generating csv report...")
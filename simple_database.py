@@ -1,14 +1,18 @@
 #!/bin/python
 
-import csv
+import array
+import collections
+import concurrent.futures
+import contextlib
 import dataclasses
 import hashlib
-import json
+import io
 import os
+import sqlite3
 import tarfile
 import tempfile
 from datetime import datetime, timezone
-from simple_utils import human_size
+from simple_utils import hash_file, human_size, json_dumps, json_load, parallel_map
 
 ### Basic utils
 
@@ -17,50 +21,49 @@ def flat_date():
 
 ### Database related functions
 
-class DatabaseFileEncoder(json.JSONEncoder):
-    def default(self, o):
-        if isinstance(o, FileEntry):
-            dict = o.__dict__
-            del(dict["db"])
-            del(dict["alt"])
-            return dict
-        elif isinstance(o, DatabaseFile):
-            return o.__dict__
-        else:
-            raise SystemError(f"No idea what to do with {o}.")
-
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class FileEntry:
     name: str
     size: int
     modified: str
-    sha: str
-    db: str = ""
-    alt: list('FileEntry') = dataclasses.field(default_factory=list)
-
-    def sha256sum(file):
-        if os.path.islink(file):
-            return hashlib.sha256(os.readlink(file).encode("utf-8")).hexdigest()
-        elif os.path.isfile(file):
-            with open(file, 'rb') as f:
-                return hashlib.file_digest(f, 'sha256').hexdigest()
+    # Raw SHA-256 digest
+    sha: bytes
+
+    # entry is an os.DirEntry, that caches the file type
+    def sha256sum(entry):
+        if entry.is_symlink():
+            # Hash the raw target bytes: same as encoding to UTF-8, without the
+            # round trip, and works for targets that are not valid UTF-8.
+            return hashlib.sha256(os.readlink(os.fsencode(entry.path))).digest()
+        elif entry.is_file(follow_symlinks=False):
+            return hash_file(entry.path, 'sha256').digest()
         else:
-            raise SystemError(f"Found a file {file} that's not a file or a link.")
-
-    def gen(indir, file):
-        absfile = os.path.join(indir, file)
+            raise SystemError(f"Found a file {entry.path} that's not a file or a link.")
 
-        stat = os.stat(absfile, follow_symlinks=False)
+    # Only stat the file, the hash is left empty.
+    def stat_only(file, entry):
+        stat = entry.stat(follow_symlinks=False)
         size = stat.st_size
-        modified = datetime.fromtimestamp(stat.st_mtime, tz=timezone.utc).isoformat()
-        sha = FileEntry.sha256sum(absfile)
-
-        return FileEntry(file, size, modified, sha)
-
-    def from_dict(d, db):
-        return FileEntry(d["name"], d["size"], d["modified"], d["sha"], db)
+        # The exact string matters, as it is compared with the database for the
+        # quick check. Formatting by hand (time.gmtime and an f-string) is
+        # slower than datetime, which is implemented in C.
+        modified = datetime.fromtimestamp(stat.st_mtime, timezone.utc).isoformat()
+
+        return FileEntry(file, size, modified, None)
+
+    # known is the FileEntry of the same file in the database, if any: if size
+    # and modification time match, assume the file is unchanged and reuse its
+    # hash, without reading the file.
+    def gen(file, entry, known=None):
+        fileentry = FileEntry.stat_only(file, entry)
+        if known is not None and known.size == fileentry.size \
+                and known.modified == fileentry.modified:
+            fileentry.sha = known.sha
+        else:
+            fileentry.sha = FileEntry.sha256sum(entry)
+        return fileentry
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class DatabaseFile:
     DBVERSION = 1
 
@@ -71,61 +74,212 @@ class DatabaseFile:
         self.data.append(file)
     
     def writeJson(self, outfile):
-        with open(outfile, "w") as dbfile:
-            json.dump(self, dbfile, cls=DatabaseFileEncoder, indent=4)
+        # Only plain dicts and lists, that the encoder handles natively, without
+        # a Python callback per entry. sha is kept as hex on disk, like
+        # sha256sum prints it.
+        data = [{"name": f.name, "size": f.size, "modified": f.modified, "sha": f.sha.hex()}
+                    for f in self.data]
+        with open(outfile, "wb") as dbfile:
+            dbfile.write(json_dumps({"data": data, "version": self.version}))
 
 class BackupDatabase:
     # 256 MB chunk is a good sweet spot pricing-wise
     # Note that chunks can be larger as we only fit in full files.
     DEFAULT_MINSIZE=256*1024*1024
 
-    # Whole database: map from filename to FileEntry
-    db = None
+    # Number of threads hashing files in parallel (hashlib releases the GIL)
+    DEFAULT_HASHWORKERS=os.cpu_count() or 8
+
+    # Number of tars that can wait for their upload to finish, while the next
+    # one is being created
+    DEFAULT_PENDINGTARS=2
+
+    # File contents are copied into the tar in chunks of that size (tarfile
+    # defaults to 16 KiB)
+    TAR_COPYBUFSIZE=4*1024*1024
+    # Small writes to the tar stream are buffered up to that size
+    TAR_WRITEBUFSIZE=1024*1024
+
+    # Write buffer for the CSV report
+    CSV_BUFSIZE=1024*1024
+
+    # Bump when the layout of the index changes
+    INDEXVERSION = 3
 
-    def __init__(self, dbcachedir, s3, minsize=DEFAULT_MINSIZE):
+    # Whole database, stored column-wise, with one row per copy of a file (a
+    # file appears multiple times if it was modified), in the order they were
+    # read: names, sizes, modifieds, shas (raw digests, half the size of hex
+    # strings), dbs (json file name).
+    # index maps a filename to the row of its latest copy, and prev links each
+    # row to the row of the previous copy of the same file (-1 if none).
+    index = None
+
+    def __init__(self, dbcachedir, s3, minsize=DEFAULT_MINSIZE, hashworkers=DEFAULT_HASHWORKERS,
+            pendingtars=DEFAULT_PENDINGTARS, indexfile=None):
         self.dbcachedir = dbcachedir
         self.s3 = s3
         # Minimum archive size
         self.minsize = minsize
+        self.hashworkers = hashworkers
+        self.pendingtars = pendingtars
+        # SQLite cache of the parsed database, to avoid parsing json on every run
+        self.indexfile = indexfile
+
+    def clear(self):
+        self.index = {}
+        self.prev = array.array('q')
+        self.names = []
+        self.sizes = array.array('q')
+        self.modifieds = []
+        self.shas = []
+        self.dbs = []
+
+    # Append (name, size, modified, sha, db) rows to the database
+    def add_rows(self, rows):
+        # Called for every file in the database: bind everything to locals
+        index = self.index
+        (prev, names, sizes, modifieds, shas, dbs) = (self.prev.append, self.names.append,
+            self.sizes.append, self.modifieds.append, self.shas.append, self.dbs.append)
+        row = len(self.names)
+        for (name, size, modified, sha, db) in rows:
+            prev(index.get(name, -1))
+            index[name] = row
+            names(name)
+            sizes(size)
+            modifieds(modified)
+            shas(sha)
+            dbs(db)
+            row += 1
+
+    # Latest copy of a file in the database, as a FileEntry (None if unknown)
+    def get(self, name):
+        row = self.index.get(name)
+        if row is None:
+            return None
+        return FileEntry(name, self.sizes[row], self.modifieds[row], self.shas[row])
+
+    def read_index(self, shards):
+        # Returns False if the index is missing or does not match the json shards
+        if not os.path.isfile(self.indexfile):
+            return False
+        try:
+            with contextlib.closing(sqlite3.connect(self.indexfile)) as conn:
+                version = conn.execute("PRAGMA user_version").fetchone()[0]
+                if version != self.INDEXVERSION * 1000 + DatabaseFile.DBVERSION:
+                    return False
+                if conn.execute("SELECT name, size, mtime FROM shards ORDER BY name").fetchall() != \
+                        [(os.fsencode(name), size, mtime) for (name, size, mtime) in shards]:
+                    return False
+                fsdecode = os.fsdecode
+                self.add_rows((fsdecode(name), size, modified, sha, fsdecode(db))
+                    for (name, size, modified, sha, db) in
+                    conn.execute("SELECT name, size, modified, sha, db FROM files ORDER BY rowid"))
+        except sqlite3.Error as e:
+            print(f"WARNING: Ignoring broken database index {self.indexfile} ({e}).")
+            self.clear()
+            return False
+        return True
+
+    def write_index(self, shards):
+        # The index is only a cache: failing to write it is not fatal, the json
+        # shards are read again next time.
+        tmpfile = f"{self.indexfile}.tmp"
+        try:
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
+            with contextlib.closing(sqlite3.connect(tmpfile)) as conn:
+                # Names are stored as bytes: file names do not have to be valid
+                # UTF-8 (Python keeps them as surrogate escapes, that sqlite
+                # cannot encode).
+                conn.execute("CREATE TABLE shards (name BLOB, size INTEGER, mtime INTEGER)")
+                conn.execute("CREATE TABLE files (name BLOB, size INTEGER, modified TEXT, sha BLOB, db BLOB)")
+                conn.executemany("INSERT INTO shards VALUES (?, ?, ?)",
+                    ((os.fsencode(name), size, mtime) for (name, size, mtime) in shards))
+                # Rows in the same order, so that read_index rebuilds the same database
+                fsencode = os.fsencode
+                conn.executemany("INSERT INTO files VALUES (?, ?, ?, ?, ?)",
+                    zip(map(fsencode, self.names), self.sizes, self.modifieds, self.shas,
+                        map(fsencode, self.dbs)))
+                conn.execute(f"PRAGMA user_version = {self.INDEXVERSION * 1000 + DatabaseFile.DBVERSION}")
+                conn.commit()
+            os.replace(tmpfile, self.indexfile)
+        except (sqlite3.Error, UnicodeError) as e:
+            print(f"WARNING: Could not write database index {self.indexfile} ({e}).")
+            try:
+                os.remove(tmpfile)
+            except FileNotFoundError:
+                pass
 
     def read_database(self):
         # Read existing database
-        self.db = {}
+        self.clear()
         dbfiles = [f for f in os.listdir(self.dbcachedir) if f.endswith(".json")]
         dbfiles.sort()
+
+        if self.indexfile:
+            shards = []
+            for j in dbfiles:
+                stat = os.stat(os.path.join(self.dbcachedir, j))
+                shards.append((j, stat.st_size, stat.st_mtime_ns))
+            if self.read_index(shards):
+                print(f"Read database (from index): {len(self.index)} files.")
+                return
+
         for j in dbfiles:
-            with open(os.path.join(self.dbcachedir, j), "r") as read_content:
+            with open(os.path.join(self.dbcachedir, j), "rb") as read_content:
                 try:
-                    jsondata = json.load(read_content)
+                    jsondata = json_load(read_content)
                 except Exception as e:
                     raise ValueError(f"Database error in {j}.") from e
                 if jsondata["version"] != DatabaseFile.DBVERSION:
                     raise SystemError(f"Database version error in {j}: {jsondata["version"]}")
-                for file in jsondata["data"]:
-                    fe = FileEntry.from_dict(file, j)
-                    # Save other copies in alt
-                    existing = self.db.get(fe.name)
-                    if existing:
-                        fe.alt = [ existing ] + existing.alt
-                        existing.alt = []
-                    self.db[fe.name] = fe
-        print(f"Read database: {len(self.db)} files.")
+                self.add_rows((file["name"], file["size"], file["modified"], bytes.fromhex(file["sha"]), j)
+                    for file in jsondata["data"])
+        print(f"Read database: {len(self.index)} files.")
+
+        if self.indexfile:
+            self.write_index(shards)
 
     def create_tar(self, tardb, indir, basefilepath, size, storageclass):
         print(f"Creating tar {basefilepath} with {len(tardb.data)} files ({human_size(size)}).")
 
-        with tempfile.NamedTemporaryFile() as outtarobj:
-            with tarfile.open(fileobj=outtarobj, mode="w") as tar:
-                for fileentry in tardb.data:
-                    tar.add(os.path.join(indir, fileentry.name),
-                        arcname=fileentry.name, recursive="False")
-            self.s3.upload_file(outtarobj.name, "data", basefilepath + ".tar", storageclass=storageclass)
+        # Stream the tar to S3 while it is being created. The part size must be
+        # chosen upfront, from an upper bound of the tar size: per member, a
+        # header, a pax header with long names (and link targets, counted in
+        # size), padding to 512 bytes; then the end-of-archive record.
+        tarsize = size + tarfile.RECORDSIZE + sum(
+            5*512 + 2*len(os.fsencode(fileentry.name)) for fileentry in tardb.data)
+        upload = self.s3.open_upload("data", basefilepath + ".tar", storageclass=storageclass,
+            partsize=self.s3.partsize(tarsize))
+        try:
+            # tarfile writes headers in 512-byte blocks, coalesce them
+            stream = io.BufferedWriter(upload, buffer_size=self.TAR_WRITEBUFSIZE)
+            try:
+                with tarfile.open(fileobj=stream, mode="w", copybufsize=self.TAR_COPYBUFSIZE) as tar:
+                    for fileentry in tardb.data:
+                        tar.add(os.path.join(indir, fileentry.name),
+                            arcname=fileentry.name, recursive=False)
+            finally:
+                # Flush, without closing the upload
+                stream.detach()
+        except BaseException:
+            upload.close()
+            raise
+        return upload
+
+    def finish_tar(self, upload, tardb, basefilepath):
+        # Complete the tar upload before uploading the json, so that a json
+        # never references a missing tar.
+        try:
+            upload.complete()
+        finally:
+            upload.close()
 
         outjson = os.path.join(self.dbcachedir, basefilepath + ".json")
         tardb.writeJson(outjson)
         self.s3.upload_file(outjson, "db", storageclass="STANDARD")
 
-    def create_tars(self, indir, inlist, storageclass):
+    def create_tars(self, indir, inlist, storageclass, checksum=False):
         class FileNameGen:
             def __init__(self, prefix):
                 self.prefix = prefix
@@ -145,48 +299,80 @@ class BackupDatabase:
         lastskip = 0
         totalwritten = 0
 
-        for file in inlist:
-            fileentry = FileEntry.gen(indir, file)
-
-            dbfile = self.db.get(file)
-            if dbfile and dbfile.sha == fileentry.sha:
-                totalskip += 1
-                if totalskip >= lastskip+1000:
-                    print(f"Skipped {totalskip} files so far.")
-                    lastskip = totalskip
-                continue
-
-            totalwritten += 1
-
-            size += fileentry.size
-            tardb.add(fileentry)
-            if size > self.minsize:
-                if totalskip > lastskip:
-                    print(f"Skipped {totalskip} files so far.")
-                    lastskip = totalskip
-
-                self.create_tar(tardb, indir, filenamegen.next(), size, storageclass)
-                tardb = DatabaseFile()
-                size = 0
-
-        # Create the last archive
-        if len(tardb.data) > 0:
-            self.create_tar(tardb, indir, filenamegen.next(), size, storageclass)
+        def gen_fileentry(inentry):
+            (file, entry) = inentry
+            return FileEntry.gen(file, entry, None if checksum else self.get(file))
+
+        # Tars are finished one at a time, in order, in the background
+        finisher = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        pending = collections.deque()
+
+        def queue_tar(tardb, size):
+            basefilepath = filenamegen.next()
+            upload = self.create_tar(tardb, indir, basefilepath, size, storageclass)
+            pending.append(finisher.submit(self.finish_tar, upload, tardb, basefilepath))
+            while len(pending) > self.pendingtars:
+                pending.popleft().result()
+
+        with finisher:
+            # Hash files ahead in a thread pool, then pack them in order
+            fileentries = parallel_map(gen_fileentry, inlist, self.hashworkers)
+            for fileentry in fileentries:
+                file = fileentry.name
+
+                row = self.index.get(file)
+                if row is not None and self.shas[row] == fileentry.sha:
+                    totalskip += 1
+                    if totalskip >= lastskip+1000:
+                        print(f"Skipped {totalskip} files so far.")
+                        lastskip = totalskip
+                    continue
+
+                totalwritten += 1
+
+                # Files larger than the chunk size get a tar of their own: if one
+                # of them changes, the small files around it are not uploaded again.
+                # Same comparison as below, so that such a file is always alone.
+                if fileentry.size > self.minsize and len(tardb.data) > 0:
+                    queue_tar(tardb, size)
+                    tardb = DatabaseFile()
+                    size = 0
+
+                size += fileentry.size
+                tardb.add(fileentry)
+                if size > self.minsize:
+                    if totalskip > lastskip:
+                        print(f"Skipped {totalskip} files so far.")
+                        lastskip = totalskip
+
+                    queue_tar(tardb, size)
+                    tardb = DatabaseFile()
+                    size = 0
+
+            # Create the last archive
+            if len(tardb.data) > 0:
+                queue_tar(tardb, size)
+
+            while pending:
+                pending.popleft().result()
 
         print(f"Done! Wrote {totalwritten} files. Skipped {totalskip} files.")
         return (totalwritten, totalskip)
 
     def generate_CSV(self):
-        with tempfile.NamedTemporaryFile(mode='w+') as outcsvobj:
-            csvwriter = csv.writer(outcsvobj, quoting=csv.QUOTE_NONNUMERIC)
-            csvwriter.writerow(["tar File", "Filename", "Size", "Modified", "SHA"])
-            for file in self.db:
-                def file_to_array(fe):
-                    tarname = fe.db.removesuffix(".json") + ".tar"
-                    return (tarname, file, fe.size, fe.modified, fe.sha)
-
-                csvwriter.writerow(file_to_array(self.db[file]))
-                for altfile in self.db[file].alt:
-                    csvwriter.writerow(file_to_array(altfile))
+        # Same output as csv.writer with QUOTE_NONNUMERIC, built directly: only
+        # names can contain quotes, which are doubled.
+        with tempfile.NamedTemporaryFile(mode='w+', buffering=self.CSV_BUFSIZE) as outcsvobj:
+            write = outcsvobj.write
+            write('"tar File","Filename","Size","Modified","SHA"\r\n')
+            for file, row in self.index.items():
+                quotedfile = file.replace('"', '""')
+                # Latest copy first, then previous ones
+                while row >= 0:
+                    tarname = self.dbs[row].removesuffix(".json").replace('"', '""') + ".tar"
+                    write(f'"{tarname}","{quotedfile}",{self.sizes[row]},"{self.modifieds[row]}","{self.shas[row].hex()}"\r\n')
+                    row = self.prev[row]
+            # Uploaded by name: make sure everything is written out
+            outcsvobj.flush()
 
             self.s3.upload_file(outcsvobj.name, "report", flat_date() + ".csv")
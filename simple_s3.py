@@ -1,18 +1,28 @@
 #!/bin/python
 
 import argparse
+import array
+import base64
+import bisect
 import boto3
+import botocore.config
+import botocore.exceptions
+import collections.abc
+import concurrent.futures
+import csv
 import dataclasses
+import gzip
 import hashlib
+import io
 import os
 import pprint
 import sys
 import threading
 import time
 import urllib.parse
-from simple_utils import human_size_2, human_size_f, list_files
+from simple_utils import hash_file, human_size, human_size_2, human_size_f, json_dumps, json_load, list_files, multipart_etag, parallel_map
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class S3File:
     name: str
     size: int
@@ -20,23 +30,111 @@ class S3File:
     md5: str
     # TODO: Do we want to store sha as well?
 
-    def gen_from_s3(content, prefix):
+    # Returns (name, size, storageclass, md5). prefixlen is len(prefix),
+    # computed once by the caller for all objects.
+    def parse_s3(content, prefix, prefixlen):
         name = content["Key"]
         # Trim prefix (this could be done with os.path functions?)
         if not name.startswith(prefix):
             raise SystemError(f"Weird name {name} does not start with {prefix}")
-        name = name[len(prefix):]
+        name = name[prefixlen:]
         size = content["Size"]
         storageclass = content["StorageClass"]
         # TODO: We also stored a SHA-256 but that requires one more operation.
         md5 = content["ETag"].strip('"')
         # TODO: Hack, for now, add restore status to the class string
-        if "RestoreStatus" in content:
-            if content["RestoreStatus"]["IsRestoreInProgress"]:
+        restore = content.get("RestoreStatus")
+        if restore is not None:
+            if restore["IsRestoreInProgress"]:
                 storageclass += " (restoring)"
             else:
-                storageclass += f" (restored until {content["RestoreStatus"]["RestoreExpiryDate"]})"
-        return S3File(name, size, storageclass, md5)
+                storageclass += f" (restored until {restore["RestoreExpiryDate"]})"
+        return (name, size, storageclass, md5)
+
+    def gen_from_s3(content, prefix, prefixlen):
+        return S3File(*S3File.parse_s3(content, prefix, prefixlen))
+
+class S3FileList(collections.abc.Mapping):
+    # Read-only dict of name: S3File, for a whole bucket listing. Stored
+    # column-wise (names only in the index, sizes in an array, storage classes
+    # as indexes in a small table), S3File objects are only created on access.
+    def __init__(self):
+        self.index = {}
+        self.sizes = array.array('q')
+        self.storageclasses = array.array('H')
+        self.classnames = []
+        self.classtable = {}
+        self.md5s = []
+        # Sorted names, built on demand for prefix lookups
+        self.sortednames = None
+
+    def add(self, name, size, storageclass, md5):
+        classindex = self.classtable.get(storageclass)
+        if classindex is None:
+            classindex = self.classtable[storageclass] = len(self.classnames)
+            self.classnames.append(storageclass)
+        self.index[name] = len(self.md5s)
+        self.sizes.append(size)
+        self.storageclasses.append(classindex)
+        self.md5s.append(md5)
+        self.sortednames = None
+
+    def __getitem__(self, name):
+        row = self.index[name]
+        return S3File(name, self.sizes[row], self.classnames[self.storageclasses[row]], self.md5s[row])
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+    # Plain lists of the columns (rows in the same order), and back: names and
+    # sizes are not repeated in every row, storage classes are small integers.
+    def columns(self):
+        return {
+            "names": list(self.index),
+            "sizes": self.sizes.tolist(),
+            "storageclasses": self.storageclasses.tolist(),
+            "classnames": self.classnames,
+            "md5s": self.md5s
+        }
+
+    def from_columns(columns):
+        files = S3FileList()
+        files.index = {name: row for (row, name) in enumerate(columns["names"])}
+        files.sizes = array.array('q', columns["sizes"])
+        files.storageclasses = array.array('H', columns["storageclasses"])
+        files.classnames = columns["classnames"]
+        files.classtable = {name: i for (i, name) in enumerate(files.classnames)}
+        files.md5s = columns["md5s"]
+        if not len(files.index) == len(files.sizes) == len(files.storageclasses) == len(files.md5s):
+            raise ValueError("Inconsistent columns in file list.")
+        return files
+
+    # (name, size, storageclass, md5) tuples, without creating S3File objects.
+    # With a prefix, only names starting with it, in sorted order.
+    def rows(self, prefix=""):
+        if not prefix:
+            for (name, row) in self.index.items():
+                yield (name, self.sizes[row], self.classnames[self.storageclasses[row]], self.md5s[row])
+            return
+
+        # Matching names are contiguous once sorted: find the first one with a
+        # binary search, instead of going over the whole bucket. Listings
+        # already come sorted, so the sort itself is cheap.
+        if self.sortednames is None:
+            self.sortednames = sorted(self.index)
+        names = self.sortednames
+        for i in range(bisect.bisect_left(names, prefix), len(names)):
+            name = names[i]
+            if not name.startswith(prefix):
+                break
+            row = self.index[name]
+            yield (name, self.sizes[row], self.classnames[self.storageclasses[row]], self.md5s[row])
 
 def addslash(s):
     s = s.removeprefix("/")
@@ -47,56 +145,199 @@ def addslash(s):
 class SimpleS3:
     # TODO: Make this a parameter, chunk size for multipart upload
     DEFAULT_CHUNKSIZE=32*1024*1024
-
-    def __init__(self, url, dry_run=False):
+    # S3 limit on the number of parts of a multipart upload. Larger uploads
+    # use larger parts, see partsize.
+    MAX_PARTS=10000
+    # Number of parts uploaded in parallel
+    DEFAULT_CONCURRENCY=8
+    # Number of files downloaded/uploaded in parallel (latency dominates for
+    # small files)
+    DEFAULT_DOWNLOADWORKERS=16
+    DEFAULT_UPLOADWORKERS=16
+    # Size of the HTTP connection pool (botocore defaults to 10)
+    MAX_CONNECTIONS=32
+    # Number of local files hashed in parallel
+    DEFAULT_HASHWORKERS=min(8, os.cpu_count() or 1)
+    # Read size of transfers
+    IO_CHUNKSIZE=1024*1024
+    # Keys per listing request (the maximum S3 returns)
+    LIST_PAGESIZE=1000
+    # Format of the list cache, older caches are ignored
+    LISTCACHEVERSION=2
+
+    # listcache: optional file where the full listing is cached, reused by
+    # list_files for listcachettl seconds (0 disables the cache). Any upload
+    # invalidates it, even if the cache is disabled for this run.
+    def __init__(self, url, dry_run=False, listcache=None, listcachettl=0):
         self.dry_run = dry_run
-
-        self.s3_client = boto3.client('s3')
+        self.listcache = listcache
+        self.listcachettl = listcachettl
+
+        # The client is shared by all download and upload threads: make sure
+        # its connection pool is large enough for all of them.
+        self.s3_client = boto3.client('s3',
+            config=botocore.config.Config(max_pool_connections=self.MAX_CONNECTIONS,
+                tcp_keepalive=True))
         self.files = None
+        # Files uploaded (or being uploaded) since the listing: name: status
+        self.uploads = {}
+        self.fileslock = threading.Lock()
         parse = urllib.parse.urlparse(url)
         if parse.scheme != "s3":
             raise SystemError(f"Bad URL {url} does not start with s3.")
         self.bucket = parse.netloc
         self.prefix = addslash(parse.path)
 
+        # Used for both uploads and downloads. io_chunksize is the size of the
+        # reads from the file or the network (defaults to 256 KiB).
         self.transferconfig = boto3.s3.transfer.TransferConfig(
-            multipart_threshold=self.DEFAULT_CHUNKSIZE, multipart_chunksize=self.DEFAULT_CHUNKSIZE)
+            multipart_threshold=self.DEFAULT_CHUNKSIZE, multipart_chunksize=self.DEFAULT_CHUNKSIZE,
+            max_concurrency=self.DEFAULT_CONCURRENCY, io_chunksize=self.IO_CHUNKSIZE)
+
+        # Uploads parts of all MultipartUpload streams. partslots caps the
+        # number of parts held in memory, across all uploads.
+        self.partexecutor = concurrent.futures.ThreadPoolExecutor(max_workers=self.DEFAULT_CONCURRENCY)
+        self.partslots = threading.BoundedSemaphore(self.DEFAULT_CONCURRENCY + 2)
 
         print(f"Bucket: {self.bucket}, Prefix: '{self.prefix}'{' (DRY RUN)' if self.dry_run else ''}")
 
-    def list_files(self):
-        self.files = {}
-        start_after = ""
-        is_truncated = True
-        while is_truncated:
-            response = self.s3_client.list_objects_v2(Bucket=self.bucket, Prefix=self.prefix,
-                StartAfter=start_after, OptionalObjectAttributes=['RestoreStatus'])
-            is_truncated = response["IsTruncated"]
-            if is_truncated:
-                start_after = response["Contents"][-1]["Key"]
-            for content in response.get("Contents", {}):
-                s3file = S3File.gen_from_s3(content, self.prefix)
-                self.files[s3file.name] = s3file
-        print(f"Got {len(self.files)} files in bucket folder.")
-        return self.files
+    # List files, filtered server-side to subdir if provided. Only the full
+    # listing is kept in self.files (used to refuse overriding files).
+    def list_files(self, subdir=""):
+        subdir = addslash(subdir)
+        if subdir == "" and self.read_list_cache():
+            return self.files
+        files = S3FileList()
+        (prefix, prefixlen) = (self.prefix, len(self.prefix))
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix + subdir,
+                OptionalObjectAttributes=['RestoreStatus'],
+                PaginationConfig={'PageSize': self.LIST_PAGESIZE}):
+            for content in page.get("Contents", ()):
+                files.add(*S3File.parse_s3(content, prefix, prefixlen))
+        if subdir == "":
+            self.files = files
+            self.write_list_cache()
+        print(f"Got {len(files)} files in bucket folder {self.prefix}{subdir}.")
+        return files
+
+    def read_list_cache(self):
+        if self.listcache is None or self.listcachettl <= 0:
+            return False
+        try:
+            age = time.time() - os.path.getmtime(self.listcache)
+        except FileNotFoundError:
+            return False
+        if age > self.listcachettl:
+            return False
+        # A broken cache is not fatal: list the bucket instead, the cache is
+        # rewritten afterwards.
+        try:
+            with open(self.listcache, "rb") as f:
+                cache = json_load(f)
+            if (cache.get("version") != self.LISTCACHEVERSION or
+                    cache["bucket"] != self.bucket or cache["prefix"] != self.prefix):
+                return False
+            files = S3FileList.from_columns(cache["files"])
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            print(f"WARNING: Ignoring broken list cache {self.listcache} ({e!r}).")
+            return False
+        self.files = files
+        print(f"Got {len(self.files)} files in bucket folder {self.prefix} (cached {int(age)}s ago).")
+        return True
+
+    def write_list_cache(self):
+        if self.listcache is None or self.listcachettl <= 0:
+            return
+        cache = {
+            "version": self.LISTCACHEVERSION,
+            "bucket": self.bucket,
+            "prefix": self.prefix,
+            "files": self.files.columns()
+        }
+        tmpfile = f"{self.listcache}.tmp"
+        with open(tmpfile, "wb") as f:
+            f.write(json_dumps(cache, indent=False))
+        os.replace(tmpfile, self.listcache)
+
+    def invalidate_list_cache(self):
+        if self.listcache is None:
+            return
+        try:
+            os.remove(self.listcache)
+        except FileNotFoundError:
+            pass
+
+    # List files from an S3 Inventory report (CSV format), instead of listing
+    # the bucket: much faster for huge buckets. manifesturl is the s3:// URL of
+    # the manifest.json of the report. The report can be up to a day old, so
+    # this is not used to decide what to upload.
+    def list_inventory(self, manifesturl):
+        parse = urllib.parse.urlparse(manifesturl)
+        if parse.scheme != "s3":
+            raise SystemError(f"Bad URL {manifesturl} does not start with s3.")
+        response = self.s3_client.get_object(Bucket=parse.netloc, Key=parse.path.removeprefix("/"))
+        manifest = json_load(response["Body"])
+        if manifest["fileFormat"] != "CSV":
+            raise SystemError(f"Unsupported inventory format {manifest["fileFormat"]}.")
+        if manifest["sourceBucket"] != self.bucket:
+            raise SystemError(f"Inventory is for bucket {manifest["sourceBucket"]}, not {self.bucket}.")
+        # Destination is given as an ARN
+        inventorybucket = manifest["destinationBucket"].split(":::")[-1]
+        schema = [column.strip() for column in manifest["fileSchema"].split(",")]
+        for column in ("Key", "Size", "StorageClass", "ETag"):
+            if column not in schema:
+                raise SystemError(f"Inventory does not include the {column} field.")
+        (key, size, storageclass, etag) = (schema.index("Key"), schema.index("Size"),
+            schema.index("StorageClass"), schema.index("ETag"))
+        # Inventories that include all versions: only keep current ones
+        islatest = schema.index("IsLatest") if "IsLatest" in schema else None
+        isdeletemarker = schema.index("IsDeleteMarker") if "IsDeleteMarker" in schema else None
+
+        (prefix, prefixlen) = (self.prefix, len(self.prefix))
+        def read_csv(file):
+            response = self.s3_client.get_object(Bucket=inventorybucket, Key=file["key"])
+            rows = []
+            with gzip.open(response["Body"], "rt", newline="") as f:
+                for row in csv.reader(f):
+                    if islatest is not None and row[islatest] != "true":
+                        continue
+                    if isdeletemarker is not None and row[isdeletemarker] == "true":
+                        continue
+                    # Keys are URL-encoded
+                    name = urllib.parse.unquote_plus(row[key])
+                    if not name.startswith(prefix):
+                        continue
+                    rows.append((name[prefixlen:], int(row[size]), row[storageclass], row[etag]))
+            return rows
+
+        # Same (sorted) order as a listing
+        rows = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.DEFAULT_DOWNLOADWORKERS) as executor:
+            for filerows in executor.map(read_csv, manifest["files"]):
+                rows += filerows
+        rows.sort()
+        files = S3FileList()
+        for row in rows:
+            files.add(*row)
+        print(f"Got {len(files)} files in bucket folder {prefix} (from inventory).")
+        return files
 
     def list_versions(self):
         latest = {}
         outdated = {}
-        next_key_marker = ""
-        is_truncated = True
-        while is_truncated:
-            response = self.s3_client.list_object_versions(Bucket=self.bucket, Prefix=self.prefix,
-                    KeyMarker=next_key_marker, OptionalObjectAttributes=['RestoreStatus'])
-            is_truncated = response["IsTruncated"]
-            if is_truncated:
-                next_key_marker = response["NextKeyMarker"]
-            for content in response.get("Versions", ()):
-                s3file = S3File.gen_from_s3(content, self.prefix)
+        (prefix, prefixlen) = (self.prefix, len(self.prefix))
+        paginator = self.s3_client.get_paginator('list_object_versions')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix,
+                OptionalObjectAttributes=['RestoreStatus'],
+                PaginationConfig={'PageSize': self.LIST_PAGESIZE}):
+            for content in page.get("Versions", ()):
+                s3file = S3File.gen_from_s3(content, prefix, prefixlen)
                 if content["IsLatest"]:
                     latest[s3file.name] = s3file
                 else:
-                    outdated[s3file.name] = outdated.get(s3file.name, []) + [ s3file ]
+                    # Append in place, rather than copying the list for every version
+                    outdated.setdefault(s3file.name, []).append(s3file)
         print(f"Got {len(latest)} latest files in bucket folder, and {len(outdated)} outdated files.")
         return (latest, outdated)
 
@@ -105,68 +346,95 @@ class SimpleS3:
         subdir = addslash(subdir)
 
         if self.files is None:
-            self.list_files()
-
-        localfiles = os.listdir(localdir)
-        localfiles.sort()
-        goodfiles = []
+            files = self.list_files(subdir)
+        else:
+            files = self.files
+
+        # name: DirEntry (caches stat results)
+        with os.scandir(localdir) as it:
+            localfiles = {entry.name: entry for entry in it}
+        goodfiles = set()
+        # (file, localfilebase, md5) of local copies that need an MD5 check
+        checks = []
+
+        # Downloads start as soon as a file is known to be missing or bad, and
+        # run in parallel (latency dominates for small files), while local
+        # copies are still being checked.
+        # A single transfer manager for all of them: client.download_file
+        # creates (and shuts down) a new one, with its thread pools, per file.
+        downloadconfig = boto3.s3.transfer.TransferConfig(
+            multipart_threshold=self.DEFAULT_CHUNKSIZE, multipart_chunksize=self.DEFAULT_CHUNKSIZE,
+            max_concurrency=self.DEFAULT_DOWNLOADWORKERS, io_chunksize=self.IO_CHUNKSIZE)
+        downloader = boto3.s3.transfer.create_transfer_manager(self.s3_client, downloadconfig)
+        downloads = []
+
+        def pull(file, localfilebase):
+            print(f"Downloading {localfilebase}...")
+            downloads.append(downloader.download(self.bucket, self.prefix + file,
+                os.path.join(localdir, localfilebase)))
+            goodfiles.add(localfilebase)
 
-        for file in self.files:
-            if not file.startswith(subdir):
-                continue
-            localfilebase = file[len(subdir):]
+        # Keep a backup of local files that are replaced or unknown
+        def backup(localfilebase):
             localfile = os.path.join(localdir, localfilebase)
+            os.rename(localfile, localfile + "~")
 
-            pull = False
-            if localfilebase in localfiles:
-                pull = False
-                stat = os.stat(localfile, follow_symlinks=False)
+        def move_away(file, localfilebase, bad):
+            print(f"Local file {localfilebase} incorrect ({bad}), moving away.")
+            backup(localfilebase)
+            pull(file, localfilebase)
+
+        with downloader:
+            # Row by row, without creating S3File objects
+            sublen = len(subdir)
+            for (file, size, storageclass, md5) in files.rows(subdir):
+                localfilebase = file[sublen:]
+
+                entry = localfiles.get(localfilebase)
+                if entry is None:
+                    pull(file, localfilebase)
+                    continue
+
+                # The file type comes with the directory listing, stat is only
+                # needed (and cached) for regular files
+                if entry.is_symlink():
+                    move_away(file, localfilebase, "link")
+                elif size != entry.stat(follow_symlinks=False).st_size:
+                    move_away(file, localfilebase, "size")
+                elif "-" in md5 and md5.split("-")[1] != str(-(-size // self.partsize(size))):
+                    # Multipart upload, with a part size other than ours: the
+                    # ETag cannot be computed locally. Do not read the file for
+                    # nothing, the size check will have to do.
+                    goodfiles.add(localfilebase)
+                else:
+                    checks.append((file, localfilebase, md5, size))
+
+            # Hash local copies in parallel (hashlib releases the GIL)
+            def md5sum(check):
+                return self.local_etag(os.path.join(localdir, check[1]), check[2], check[3])
 
-                bad = None
-                if os.path.islink(localfile):
-                    bad = "link"
-                elif self.files[file].size != stat.st_size:
-                    bad = "size"
+            for ((file, localfilebase, s3md5, size), md5) in zip(checks,
+                    parallel_map(md5sum, checks, self.DEFAULT_HASHWORKERS)):
+                if s3md5 != md5:
+                    print(f"{s3md5} != {md5}")
+                    move_away(file, localfilebase, "hash")
                 else:
-                    # TODO: This will never match if the file is multipart
-                    # We store the SHA-256, but MD5 is readily available.
-                    with open(localfile, 'rb') as f:
-                        md5 = hashlib.file_digest(f, 'md5').hexdigest()
-                    if self.files[file].md5 != md5:
-                        print(f"{self.files[file].md5} != {md5}")
-                        bad = "hash"
-
-                if bad is None:
                     # print(f"Local file {localfilebase} already good.")
                     # Good local copy
-                    goodfiles.append(localfilebase)
-                else:
-                    print(f"Local file {localfilebase} incorrect ({bad}), moving away.")
-                    os.rename(localfile, localfile + "~")
-                    pull = True
-            else:
-                pull = True
+                    goodfiles.add(localfilebase)
 
-            if not pull:
-                continue
-            
-            print(f"Downloading {localfilebase}...")
-            objectname = self.prefix + file
-            self.s3_client.download_file(self.bucket, objectname, localfile)
-            goodfiles.append(localfilebase)
+            # Propagate exceptions
+            for future in downloads:
+                future.result()
 
-        # Check for leftovers
-        for localfilebase in localfiles:
-            if localfilebase in goodfiles:
-                continue
+        # Check for leftovers (sorted, for consistent output)
+        for localfilebase in sorted(localfiles.keys() - goodfiles):
             # Already a backup
             if localfilebase.endswith("~"):
                 continue
-            
-            # Make a backup
+
             print(f"Found leftover file {localfilebase} in local database, moving away.")
-            localfile = os.path.join(localdir, localfilebase)
-            os.rename(localfile, localfile + "~")
+            backup(localfilebase)
 
     def upload_file(self, filename, subdir="", targetname=None, storageclass="STANDARD"):
         """Upload a file to an S3 bucket
@@ -175,33 +443,65 @@ class SimpleS3:
         :param bucket: Bucket to upload to
         """
 
-        if self.files is None:
-            self.list_files()
-
         if targetname is None:
             targetname = os.path.basename(filename)
 
         subdir = addslash(subdir)
         objectname = self.prefix + subdir + targetname
 
-        if targetname in self.files:
-            raise FileExistsError(f"Refusing to override existing file {targetname} in bucket.")
+        size = os.path.getsize(filename)
+        self.reserve_name(targetname)
+
+        # The listing may be out of date (list cache, other writers): check
+        # the object itself. A HEAD is cheap compared to an upload, and the
+        # local file is only hashed if there is an object of the same size.
+        try:
+            remote = self.head_file(objectname)
+            if (remote is not None and remote[1] == size and
+                    remote[0] == self.local_etag(filename, remote[0], size)):
+                print(f"{targetname} already in s3://{self.bucket}/{self.prefix}{subdir}, skipping.")
+                self.uploads[targetname] = "Uploaded"
+                return
+        except BaseException:
+            self.release_name(targetname)
+            raise
+        if remote is not None:
+            self.release_name(targetname)
+            raise FileExistsError(f"Refusing to override existing file {targetname} in bucket (content differs).")
 
         if self.dry_run:
             print(f"DRY RUN: Would have uploaded {targetname} to s3://{self.bucket}/{self.prefix}{subdir} ({storageclass}).")
+            self.uploads[targetname] = "Uploaded"
+            return
+
+        if size > self.DEFAULT_CHUNKSIZE:
+            # Large file: stream it through a MultipartUpload, so that its parts
+            # go through the same pool as tar uploads (bounded memory, shared
+            # connections), with the same checksums and abort on failure.
+            partsize = self.partsize(size)
+            try:
+                upload = MultipartUpload(self, subdir, targetname, storageclass, partsize)
+            except BaseException:
+                self.release_name(targetname)
+                raise
+            with upload, open(filename, "rb", buffering=0) as f:
+                upload.write_from(f)
             return
 
         sys.stdout.write(f"Uploading {targetname}...")
         sys.stdout.flush()
 
-        # Upload the file
-        size = os.path.getsize(filename)
+        # Upload the file (single PUT, below the multipart threshold)
         start = time.monotonic()
-        self.s3_client.upload_file(filename, self.bucket, objectname,
-            ExtraArgs={"ChecksumAlgorithm": "SHA256", "StorageClass": storageclass},
-            Callback=ProgressPercentage(targetname, size),
-            Config=self.transferconfig
-            )
+        try:
+            self.s3_client.upload_file(filename, self.bucket, objectname,
+                ExtraArgs={"ChecksumAlgorithm": "SHA256", "StorageClass": storageclass},
+                Callback=ProgressPercentage(targetname, size),
+                Config=self.transferconfig
+                )
+        except BaseException:
+            self.release_name(targetname)
+            raise
         interval = time.monotonic() - start
         if interval != 0:
             speed = float(size) / interval
@@ -210,7 +510,75 @@ class SimpleS3:
         sys.stdout.write(f"\rUploaded {targetname} to s3://{self.bucket}/{self.prefix}{subdir} ({human_size_f(speed)}/s, {storageclass}).\n")
 
         # Make sure we don't accidentally upload a second time
-        self.files[targetname] = "Uploaded"
+        self.uploads[targetname] = "Uploaded"
+
+    # (ETag, size) of an object, None if it does not exist
+    def head_file(self, objectname):
+        try:
+            response = self.s3_client.head_object(Bucket=self.bucket, Key=objectname)
+        except botocore.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+                return None
+            raise
+        return (response["ETag"].strip('"'), response["ContentLength"])
+
+    # Part size for a multipart upload of size bytes: DEFAULT_CHUNKSIZE, or
+    # larger (a multiple of 1 MiB) for files that would not fit in MAX_PARTS.
+    # Uploads and ETag checks must agree on it.
+    def partsize(self, size):
+        partsize = -(-size // self.MAX_PARTS)
+        partsize = -(-partsize // (1024*1024)) * 1024*1024
+        return max(self.DEFAULT_CHUNKSIZE, partsize)
+
+    # ETag that localfile (of size bytes) would have once uploaded, in the same
+    # form as etag. We store the SHA-256, but MD5 (ETag) is readily available.
+    def local_etag(self, localfile, etag, size):
+        if "-" in etag:
+            # Uploaded in parts, by upload_file
+            return multipart_etag(localfile, self.partsize(size))
+        return hash_file(localfile, 'md5').hexdigest()
+
+    def open_upload(self, subdir, targetname, storageclass="STANDARD", partsize=None):
+        """Open a stream that uploads to an S3 bucket as it is written
+
+        Once all data is written, call complete() (possibly from another
+        thread), then close(), always: close() aborts the upload if it was not
+        completed, and releases the name. Used as a context manager, this is
+        done when the block exits (aborted on exception).
+        partsize must be large enough for the whole stream to fit in MAX_PARTS
+        parts, see partsize() (defaults to DEFAULT_CHUNKSIZE).
+        """
+
+        subdir = addslash(subdir)
+        if partsize is None:
+            partsize = self.DEFAULT_CHUNKSIZE
+
+        self.reserve_name(targetname)
+        try:
+            return MultipartUpload(self, subdir, targetname, storageclass, partsize)
+        except BaseException:
+            self.release_name(targetname)
+            raise
+
+    # Uploads can run in parallel threads: check that targetname is not in the
+    # bucket, and reserve it until the upload is done (or released on failure),
+    # atomically.
+    def reserve_name(self, targetname):
+        if self.files is None:
+            self.list_files()
+
+        with self.fileslock:
+            if targetname in self.files or targetname in self.uploads:
+                raise FileExistsError(f"Refusing to override existing file {targetname} in bucket.")
+            self.uploads[targetname] = "Uploading"
+
+        # The cached listing is about to be out of date
+        if not self.dry_run:
+            self.invalidate_list_cache()
+
+    def release_name(self, targetname):
+        with self.fileslock:
+            del self.uploads[targetname]
 
     # TODO: Fully implement this
     def get_file_attributes(self, name):
@@ -235,19 +603,177 @@ class SimpleS3:
 
         return config
 
+class MultipartUpload(io.RawIOBase):
+    # Writable stream, cut into parts that are uploaded in a thread pool while
+    # the caller keeps writing. See SimpleS3.open_upload.
+    # Once all data is written, complete() can be called from another thread.
+    def __init__(self, s3, subdir, targetname, storageclass, partsize):
+        self.s3 = s3
+        self.subdir = subdir
+        self.targetname = targetname
+        self.objectname = s3.prefix + subdir + targetname
+        self.storageclass = storageclass
+        self.partsize = partsize
+        self.buffer = bytearray()
+        self.size = 0
+        self.uploaded = 0
+        self.parts = []
+        self.error = None
+        self.completed = False
+        self._lock = threading.Lock()
+        self.start = time.monotonic()
+
+        self.uploadid = None
+        if s3.dry_run:
+            return
+        response = s3.s3_client.create_multipart_upload(Bucket=s3.bucket, Key=self.objectname,
+            ChecksumAlgorithm="SHA256", StorageClass=storageclass)
+        self.uploadid = response["UploadId"]
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.size
+
+    def write(self, b):
+        if self.error:
+            raise self.error
+        # Fill the buffer up to the part size exactly, then hand it over to
+        # the part upload as is: data is only copied once, into the buffer.
+        view = memoryview(b).cast("B")
+        size = len(view)
+        partsize = self.partsize
+        while view:
+            room = partsize - len(self.buffer)
+            self.buffer += view[:room]
+            view = view[room:]
+            if len(self.buffer) >= partsize:
+                self._flush_part()
+        self.size += size
+        return size
+
+    # Write the rest of file object f: each part is read straight into its own
+    # buffer, that is handed over to the part upload (no copy at all).
+    # Only on a part boundary, e.g. on a new upload.
+    def write_from(self, f):
+        if self.buffer:
+            raise ValueError("write_from can only start on a part boundary.")
+        partsize = self.partsize
+        while True:
+            if self.error:
+                raise self.error
+            data = bytearray(partsize)
+            with memoryview(data) as view:
+                length = 0
+                while length < partsize and (n := f.readinto(view[length:])):
+                    length += n
+            del data[length:]
+            self.buffer = data
+            self.size += length
+            if length < partsize:
+                # End of file: complete() uploads the last part
+                return
+            self._flush_part()
+
+    def _flush_part(self):
+        data = self.buffer
+        self.buffer = bytearray()
+        partnumber = len(self.parts) + 1
+        if partnumber > self.s3.MAX_PARTS:
+            raise ValueError(f"{self.targetname} does not fit in {self.s3.MAX_PARTS} parts of {human_size(self.partsize)}.")
+        if self.uploadid is None:
+            # Dry run
+            self.parts.append(None)
+            return
+        self.s3.partslots.acquire()
+        future = self.s3.partexecutor.submit(self._upload_part, partnumber, data)
+        future.add_done_callback(self._part_done)
+        self.parts.append(future)
+
+    def _part_done(self, future):
+        if not future.cancelled() and future.exception():
+            self.error = future.exception()
+        self.s3.partslots.release()
+
+    def _upload_part(self, partnumber, data):
+        # Compute the checksum ourselves, in this worker thread (hashlib releases
+        # the GIL), and send it along: botocore then does not go over the data.
+        checksum = base64.b64encode(hashlib.sha256(data).digest()).decode()
+        response = self.s3.s3_client.upload_part(Bucket=self.s3.bucket, Key=self.objectname,
+            UploadId=self.uploadid, PartNumber=partnumber, Body=data, ChecksumSHA256=checksum)
+        with self._lock:
+            self.uploaded += len(data)
+            sys.stdout.write(f"\rUploading {self.targetname} {human_size(self.uploaded)}")
+            sys.stdout.flush()
+        return {"PartNumber": partnumber, "ETag": response["ETag"], "ChecksumSHA256": checksum}
+
+    def complete(self):
+        # Last part can be smaller than the part size
+        if self.buffer or not self.parts:
+            self._flush_part()
+
+        s3 = self.s3
+        if self.uploadid is None:
+            print(f"DRY RUN: Would have uploaded {self.targetname} ({human_size(self.size)}) to s3://{s3.bucket}/{s3.prefix}{self.subdir} ({self.storageclass}).")
+        else:
+            parts = [future.result() for future in self.parts]
+            s3.s3_client.complete_multipart_upload(Bucket=s3.bucket, Key=self.objectname,
+                UploadId=self.uploadid, MultipartUpload={"Parts": parts})
+            interval = time.monotonic() - self.start
+            if interval != 0:
+                speed = float(self.size) / interval
+            else:
+                speed = 0
+            sys.stdout.write(f"\rUploaded {self.targetname} to s3://{s3.bucket}/{s3.prefix}{self.subdir} ({human_size_f(speed)}/s, {self.storageclass}).\n")
+        self.completed = True
+
+        # Make sure we don't accidentally upload a second time
+        s3.uploads[self.targetname] = "Uploaded"
+
+    def close(self):
+        if not self.closed and not self.completed:
+            if self.uploadid is not None:
+                print(f"\nAborting upload of {self.targetname}.")
+                for future in self.parts:
+                    future.cancel()
+                concurrent.futures.wait(self.parts)
+                self.s3.s3_client.abort_multipart_upload(Bucket=self.s3.bucket, Key=self.objectname,
+                    UploadId=self.uploadid)
+            self.s3.release_name(self.targetname)
+        super().close()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.complete()
+        finally:
+            self.close()
+
 class ProgressPercentage(object):
+    # Minimum interval between progress updates, in seconds
+    INTERVAL = 0.1
+
     def __init__(self, filename, size):
         self._filename = filename
         self._size = size
         self._seen_so_far = 0
+        self._last_print = 0.0
         self._lock = threading.Lock()
 
     def __call__(self, bytes_amount):
         with self._lock:
             self._seen_so_far += bytes_amount
-            percentage = (self._seen_so_far / self._size) * 100
+            # Called for every chunk read by boto3: only print now and then
+            now = time.monotonic()
+            if now - self._last_print < self.INTERVAL and self._seen_so_far < self._size:
+                return
+            self._last_print = now
+            # In hundredths of a percent, rounded down: only shows 100.00% once
+            # done (empty files are done right away).
+            percentage = self._seen_so_far * 10000 // self._size if self._size else 10000
             sys.stdout.write(
-                f"\rUploading {self._filename} {human_size_2(self._seen_so_far, self._size)} ({percentage:.2f}%)")
+                f"\rUploading {self._filename} {human_size_2(self._seen_so_far, self._size)} ({percentage // 100}.{percentage % 100:02}%)")
             sys.stdout.flush()
 
 if __name__ == "__main__":
@@ -264,8 +790,11 @@ if __name__ == "__main__":
     action.add_argument('-u', '--upload', action='store', type=str, metavar="INDIR", help="upload directory to s3")
     action.add_argument('-f', '--file', action='store', type=str, help="dump file attributes")
     parser.add_argument('-c', '--class', action='store', dest='storageclass', type=str, default="STANDARD", help="upload class (e.g. STANDARD or DEEP_ARCHIVE)")
+    parser.add_argument('-I', '--inventory', action='store', type=str, metavar="MANIFEST", help="with --list, read the listing from an S3 Inventory report (s3:// URL of its manifest.json, CSV format)")
     parser.add_argument('s3url', help="S3 URL, i.e. s3://bucket/directory")
     args = parser.parse_args()
+    if args.inventory and not args.list:
+        parser.error("argument -I/--inventory: only valid with -l/--list")
 
     outurl = args.s3url
 
@@ -278,9 +807,12 @@ if __name__ == "__main__":
         fileattr = s3.get_file_attributes(args.file)
         pprint.PrettyPrinter().pprint(fileattr)
     elif args.list:
-        s3.list_files()
-        for file in s3.files:
-            s3file = s3.files[file]
+        if args.inventory:
+            files = s3.list_inventory(args.inventory)
+        else:
+            files = s3.list_files()
+        for file in files:
+            s3file = files[file]
             print(f"{file} ({s3file.size}, {s3file.storageclass})")
     elif args.upload:
         indir = os.path.abspath(args.upload)
@@ -289,12 +821,16 @@ if __name__ == "__main__":
 
         s3.list_files()
 
-        inlist = list_files(indir)
-        for file in inlist:
+        def upload(inentry):
+            (file, entry) = inentry
             try:
                 s3.upload_file(os.path.join(indir, file), targetname=file, storageclass=args.storageclass)
             except FileExistsError:
                 print(f"WARNING: Skippping existing file {file}.")
+
+        inlist = list_files(indir)
+        for _ in parallel_map(upload, inlist, SimpleS3.DEFAULT_UPLOADWORKERS):
+            pass
     elif args.versions:
         (latest, outdated) = s3.list_versions()
         for file in latest:
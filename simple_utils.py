@@ -1,47 +1,148 @@
+import collections
+import concurrent.futures
+import hashlib
+import json
 import os
 
+# Optional, but much faster than json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 SIZE_SUFFIXES = ['B', 'KiB', 'MiB', 'GiB']
 
+# Read buffer size when hashing files
+HASH_BUFSIZE = 1024*1024
+
+# Index in SIZE_SUFFIXES for a size: the number of times it can be divided by
+# 1024, straight from its bit length.
+def size_suffix_index(size):
+    if size < 1024:
+        return 0
+    return min((int(size).bit_length() - 1) // 10, len(SIZE_SUFFIXES)-1)
+
 def human_size(size):
-    i = 0
     size = int(size)
-    while size >= 1024 and i < len(SIZE_SUFFIXES)-1:
-        size = size // 1024
-        i += 1
-    return f"{size} {SIZE_SUFFIXES[i]}"
+    i = size_suffix_index(size)
+    return f"{size >> 10*i} {SIZE_SUFFIXES[i]}"
 
 def human_size_f(size):
-    i = 0
-    while size >= 1024 and i < len(SIZE_SUFFIXES)-1:
-        size = size / 1024
-        i += 1
-    return f"{size:.3f} {SIZE_SUFFIXES[i]}"
+    i = size_suffix_index(size)
+    # Dividing by a power of 2 is exact, same as dividing by 1024 i times
+    return f"{size / (1 << 10*i):.3f} {SIZE_SUFFIXES[i]}"
 
 def human_size_2(size, total):
-    i = 0
-    while total >= 1024 and i < len(SIZE_SUFFIXES)-1:
-        total = total // 1024
-        size = size // 1024
-        i += 1
-    stotal = str(total)
-    ssize = str(size).rjust(len(stotal), " ")
+    i = size_suffix_index(total)
+    stotal = str(total >> 10*i)
+    ssize = str(size >> 10*i).rjust(len(stotal), " ")
     return f"{ssize} / {stotal} {SIZE_SUFFIXES[i]}"
 
-def list_files(indir):
-    # List all files in input directory
-    inlist = []
-    for folder, subs, files in os.walk(indir, followlinks=False):
-        # Trim prefix (this could be done with os.path functions?)
-        if not folder.startswith(indir):
-            raise SystemError(f"Weird folder {folder} does not start with {indir}")
-        folder = folder[len(indir)+1:]
-
-        inlist += map(lambda f: os.path.join(folder, f), files)
-
-    # Sort for consistency
-    inlist.sort()
-    print(f"Found {len(inlist)} files.")
-    return inlist
+def hash_file(file, name):
+    # Same as hashlib.file_digest, but with a larger buffer, so that the
+    # (OpenSSL-backed) hash gets big chunks and Python loops less often.
+    # Plain reads rather than mmap: the input tree is live, and a file that is
+    # truncated while mapped kills the process with SIGBUS.
+    digest = hashlib.new(name)
+    buf = bytearray(HASH_BUFSIZE)
+    view = memoryview(buf)
+    with open(file, 'rb', buffering=0) as f:
+        while length := f.readinto(buf):
+            digest.update(view[:length])
+    return digest
+
+def multipart_etag(file, partsize):
+    # ETag that S3 gives to an object uploaded in parts of partsize bytes: the
+    # MD5 of the concatenated MD5 digests of all parts, then the number of parts.
+    digests = []
+    buf = bytearray(HASH_BUFSIZE)
+    view = memoryview(buf)
+    with open(file, 'rb', buffering=0) as f:
+        while True:
+            digest = hashlib.md5()
+            remaining = partsize
+            while remaining:
+                length = f.readinto(view[:min(remaining, HASH_BUFSIZE)])
+                if not length:
+                    break
+                digest.update(view[:length])
+                remaining -= length
+            if remaining == partsize:
+                break
+            digests.append(digest.digest())
+            if remaining:
+                break
+    return f"{hashlib.md5(b"".join(digests)).hexdigest()}-{len(digests)}"
+
+def json_load(f):
+    # f must be opened in binary mode
+    if orjson:
+        data = f.read()
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # orjson rejects escaped lone surrogates, that json writes for file
+            # names that are not valid UTF-8.
+            return json.loads(data)
+    return json.load(f)
+
+def json_dumps(obj, indent=True):
+    # Returns bytes, indented so that the output stays human readable. Caches
+    # that are only read back by us can skip the indentation.
+    if orjson:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else None)
+        except orjson.JSONEncodeError:
+            # File names that are not valid UTF-8 (surrogate escapes): json
+            # escapes them, like it always did.
+            pass
+    if indent:
+        return json.dumps(obj, indent=4).encode("utf-8")
+    return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+def list_files(indir, folder=""):
+    # Yield (relative path, DirEntry) for all files in input directory,
+    # recursively. The DirEntry caches file type and stat, saving syscalls
+    # later on. Like os.walk, symlinks to directories are neither followed
+    # nor listed.
+    # Entries are sorted within each directory, so the order is consistent
+    # without having to hold the full list in memory.
+    # Depth-first, with an explicit stack of (folder, remaining entries)
+    # instead of recursion: no recursion limit, and no chain of nested
+    # generators for every file yielded from a deep directory.
+    def scan(folder):
+        with os.scandir(os.path.join(indir, folder)) as it:
+            return iter(sorted(it, key=lambda e: e.name))
+
+    stack = [(folder, scan(folder))]
+    while stack:
+        (folder, entries) = stack[-1]
+        for entry in entries:
+            path = os.path.join(folder, entry.name)
+            if entry.is_dir():
+                if not entry.is_symlink():
+                    # Go down, the rest of this folder is picked up afterwards
+                    stack.append((path, scan(path)))
+                    break
+            else:
+                yield (path, entry)
+        else:
+            stack.pop()
+
+def parallel_map(func, iterable, workers, window=None):
+    # Like map(), but run func in a thread pool. Results are yielded in order,
+    # and at most window items are in flight, to cap memory usage.
+    # The window must be larger than the number of workers to keep them all busy.
+    if window is None:
+        window = max(64, 4*workers)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = collections.deque()
+        for item in iterable:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
 
 if __name__ == "__main__":
     print(human_size(1024))